@@ -1,11 +1,14 @@
 import streamlit as st
 import os
 import sys
+import threading
 from PIL import Image
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
 from src.pipeline import AutoCreativeEngine
+from src.generation import CreativeGenerator
+from src.progress import format_progress
 
 st.set_page_config(page_title="Auto-Creative Engine", layout="wide")
 
@@ -17,7 +20,32 @@ def save_uploaded_file(uploaded_file, dest_folder):
         f.write(uploaded_file.getbuffer())
     return path
 
+@st.cache_resource
+def shared_generator():
+    """
+    One loaded model for every browser session; sessions only keep their own job data.
+    The lock serialises jobs, since a diffusers pipeline is not safe to run concurrently.
+    """
+    return CreativeGenerator(), threading.Lock()
+
+def create_engine():
+    generator, lock = shared_generator()
+    return AutoCreativeEngine(generator=generator), lock
+
+def progress_reporter():
+    """
+    Progress bar for engine jobs. Clicking Stop (or refreshing/closing the page) makes
+    Streamlit interrupt the script at the next update, i.e. within one denoising step;
+    the engine then releases its scratch directories and workers.
+    """
+    st.button("⏹ Stop", key="stop")
+    bar = st.progress(0.0, text="Starting...")
+    def update(info):
+        bar.progress(min(info["fraction"], 1.0), text=format_progress(info))
+    return update
+
 def generate_creatives(logo_file, product_file, product_name, api_key):
+    progress = progress_reporter()
     with st.spinner("Processing... This may take a minute."):
         try:
             inputs_dir = os.path.join(os.getcwd(), "inputs")
@@ -26,37 +54,63 @@ def generate_creatives(logo_file, product_file, product_name, api_key):
 
             os.environ["GROQ_API_KEY"] = api_key
 
-            engine = AutoCreativeEngine()
-            
-            zip_path, results = engine.run(logo_path, product_path, product_name)
+            engine, lock = create_engine()
             
-            st.success("Generation Complete!")
+            with lock:
+                zip_path, results = engine.run(logo_path, product_path, product_name, progress=progress)
             
-            st.subheader("2. Generated Results")
+            # Keep only this session's job data across reruns; the model is shared
+            st.session_state["job"] = engine.job
+            st.session_state["results"] = results
+            st.session_state["zip_path"] = zip_path
             
-            cols = st.columns(2)
-            for i, res in enumerate(results):
-                img = res['image']
-                caption_text = res['caption']
-                
-                with cols[i % 2]:
-                    st.image(img, use_container_width=True)
-                    st.caption(f"**Caption**: {caption_text}")
-                    st.divider()
-
-            with open(zip_path, "rb") as fp:
-                btn = st.download_button(
-                    label="📥 Download All (ZIP)",
-                    data=fp,
-                    file_name=os.path.basename(zip_path),
-                    mime="application/zip"
-                )
+            st.success("Generation Complete!")
 
         except Exception as e:
             st.error(f"An error occurred: {e}")
             import traceback
             st.code(traceback.format_exc())
 
+def show_results():
+    results = st.session_state.get("results")
+    if not results:
+        return
+
+    st.subheader("2. Generated Results")
+    strength = st.slider(
+        "Variation strength", min_value=0.1, max_value=0.9, value=0.5, step=0.05,
+        help="How far 'More like this' moves from the original background. Lower is faster and closer."
+    )
+    
+    cols = st.columns(2)
+    for i, res in enumerate(results):
+        img = res['image']
+        caption_text = res['caption']
+        
+        with cols[i % 2]:
+            st.image(img, use_container_width=True)
+            st.caption(f"**Caption**: {caption_text}")
+            if st.button("🔁 More like this", key=f"vary_{i}"):
+                progress = progress_reporter()
+                engine, lock = create_engine()
+                with st.spinner("Generating variation..."), lock:
+                    new_res = engine.vary(res, strength=strength, progress=progress, job=st.session_state["job"])
+                if new_res:
+                    engine.add_to_package(st.session_state["zip_path"], new_res)
+                    results.append(new_res)
+                    st.rerun()
+                else:
+                    st.error("Variation failed.")
+            st.divider()
+
+    with open(st.session_state["zip_path"], "rb") as fp:
+        btn = st.download_button(
+            label="📥 Download All (ZIP)",
+            data=fp,
+            file_name=os.path.basename(st.session_state["zip_path"]),
+            mime="application/zip"
+        )
+
 def main():
     st.title("🎨 Auto-Creative Engine")
     st.markdown("Upload your brand logo and product image to generate AI creatives.")
@@ -85,5 +139,7 @@ def main():
         if st.button("🚀 Generate Creatives", type="primary"):
              generate_creatives(logo_file, product_file, product_name, api_key)
 
+    show_results()
+
 if __name__ == "__main__":
     main()
@@ -1,25 +1,50 @@
 import sys
 import os
+import signal
 
 # Add src to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
 from src.pipeline import AutoCreativeEngine
 from src.input_handler import get_inputs
+from src.progress import CancellationToken, JobCancelled, format_progress
+
+def print_progress(info):
+    print(f"\r{format_progress(info)}", end="", flush=True)
+    if info["fraction"] >= 1:
+        print()
+
+def cancel_on_interrupt(token):
+    """
+    First Ctrl+C cancels the job within one denoising step; a second one exits immediately.
+    """
+    def handler(signum, frame):
+        print("\nCancelling... (press Ctrl+C again to force quit)")
+        token.cancel()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGINT, handler)
 
 def main():
     print("=== Auto-Creative Engine ===")
     
-    # Check if arguments provided
-    if len(sys.argv) == 3:
+    # Check if arguments provided (optional third argument: number of worker processes)
+    if len(sys.argv) in (3, 4):
         logo_path = sys.argv[1]
         product_path = sys.argv[2]
     else:
         logo_path, product_path = get_inputs()
+    workers = int(sys.argv[3]) if len(sys.argv) == 4 else 1
         
     if logo_path and product_path:
-        engine = AutoCreativeEngine()
-        engine.run(logo_path, product_path)
+        engine = AutoCreativeEngine(workers=workers)
+        token = CancellationToken()
+        cancel_on_interrupt(token)
+        try:
+            engine.run(logo_path, product_path, progress=print_progress, cancel_token=token)
+        except JobCancelled:
+            print("Cancelled.")
+        finally:
+            engine.close()
     else:
         print("Aborted.")
 
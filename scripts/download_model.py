@@ -8,6 +8,7 @@ def download_model():
     print(f"Downloading {model_id} to {local_dir}...")
     snapshot_download(repo_id=model_id, local_dir=local_dir, local_dir_use_symlinks=False, ignore_patterns=["*.safetensors", "*.onnx", "*.xml"])
     print("Download complete.")
+    print("Run scripts/prepare_model.py to convert the weights to safetensors for faster loading.")
 
 if __name__ == "__main__":
     download_model()
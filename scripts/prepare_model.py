@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.generation as generation
+from src.generation import LOCAL_MODEL_PATH, WEIGHT_COMPONENTS, prepared_model_path
+
+DTYPES = ["float16", "float32"]
+
+
+def convert(source_dir, dtype_name):
+    """
+    Converts the local .bin snapshot into a safetensors copy in the target dtype
+    and checks every saved tensor against a separate load of the original .bin weights.
+    The copy is written to a temporary sibling directory and only moved into place once
+    every component passes, since the app picks up the target directory whenever it exists.
+    """
+    import torch
+    from diffusers import StableDiffusionPipeline
+    from safetensors.torch import load_file
+
+    dtype = getattr(torch, dtype_name)
+    target_dir = prepared_model_path(dtype)
+    tmp_dir = f"{target_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print(f"Loading {source_dir} (.bin)...")
+    pipe = StableDiffusionPipeline.from_pretrained(
+        source_dir,
+        torch_dtype=dtype,
+        use_safetensors=False,
+        safety_checker=None
+    )
+
+    try:
+        print(f"Saving {dtype_name} safetensors to {tmp_dir}...")
+        pipe.save_pretrained(tmp_dir, safe_serialization=True)
+
+        print("Verifying converted weights against the original .bin files...")
+        for name in WEIGHT_COMPONENTS:
+            # Reload the component from the .bin checkpoint in its stored dtype, independent of `pipe`
+            original = type(getattr(pipe, name)).from_pretrained(source_dir, subfolder=name, use_safetensors=False)
+            expected = {k: v.to(dtype) for k, v in original.state_dict().items()}
+            del original
+
+            component_dir = os.path.join(tmp_dir, name)
+            saved = {}
+            for filename in os.listdir(component_dir):
+                if filename.endswith(".safetensors"):
+                    saved.update(load_file(os.path.join(component_dir, filename)))
+
+            missing = set(expected) - set(saved)
+            unexpected = set(saved) - set(expected)
+            if missing or unexpected:
+                raise RuntimeError(f"{name}: {len(missing)} tensors missing and {len(unexpected)} unexpected in safetensors output")
+            for key, tensor in expected.items():
+                if saved[key].dtype != dtype or not torch.equal(saved[key], tensor):
+                    raise RuntimeError(f"{name}: mismatch in {key}")
+            print(f"  {name}: {len(expected)} tensors OK")
+    except BaseException:
+        # Covers failed verification as well as Ctrl+C during the multi-GB save
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # os.replace cannot overwrite a non-empty directory, so move any previous copy aside first
+    old_dir = f"{target_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(target_dir):
+        os.replace(target_dir, old_dir)
+    os.replace(tmp_dir, target_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    print("Conversion complete.")
+    return target_dir
+
+
+def measure(prepared_dir=None):
+    """
+    Loads the model on this device and prints load time and memory as JSON.
+    Loads prepared_dir (safetensors) if given, otherwise the .bin snapshot.
+    Run in a fresh subprocess so each measurement is a cold start.
+    """
+    if prepared_dir and not os.path.exists(prepared_dir):
+        sys.exit(f"Prepared model not found: {prepared_dir}")
+    generation.PREPARED_MODEL_PATH = prepared_dir
+
+    start = time.perf_counter()
+    generator = generation.CreativeGenerator()
+    generator.load_model()
+    elapsed = time.perf_counter() - start
+    if generator.pipe is None:
+        sys.exit("Model failed to load.")
+    if prepared_dir and generator.model_path != prepared_dir:
+        sys.exit(f"Prepared model failed to load; fell back to {generator.model_path}.")
+
+    stats = {"load_seconds": round(elapsed, 2)}
+    # RssAnon is private memory; RssFile is page cache that other workers can share.
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile"):
+                stats[key] = value.strip()
+    print(json.dumps(stats))
+
+
+def benchmark(target_dir, dtype_name):
+    device_dtype = str(generation.dtype).replace("torch.", "")
+    if dtype_name != device_dtype:
+        print(f"Skipping benchmark: the app loads {device_dtype} on {generation.device}, not {dtype_name}.")
+        return
+
+    results = {}
+    for label, args in (("bin", []), ("safetensors", ["--prepared-dir", target_dir])):
+        proc = subprocess.run(
+            [sys.executable, __file__, "--measure"] + args,
+            capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            print(f"Benchmark failed for {label}: {proc.stderr.strip()}")
+            return
+        results[label] = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    print(f"Cold start ({dtype_name}, {generation.device}):")
+    for label, stats in results.items():
+        print(f"  {label:12s} " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the local SD 1.5 snapshot to memory-mappable safetensors.")
+    parser.add_argument("--dtype", choices=DTYPES, help="Defaults to the dtype used on this device.")
+    parser.add_argument("--benchmark", action="store_true", help="Compare cold start and RSS of .bin vs safetensors loading.")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--prepared-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.prepared_dir)
+        return
+
+    if not os.path.exists(LOCAL_MODEL_PATH):
+        print(f"No local model at {LOCAL_MODEL_PATH}. Run scripts/download_model.py first.")
+        return
+
+    dtype_name = args.dtype or str(generation.dtype).replace("torch.", "")
+    target_dir = convert(LOCAL_MODEL_PATH, dtype_name)
+    if args.benchmark:
+        benchmark(target_dir, dtype_name)
+
+
+if __name__ == "__main__":
+    main()
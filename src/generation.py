@@ -9,6 +9,8 @@ except ImportError:
 from PIL import Image, ImageOps, ImageDraw
 import os
 
+from .progress import JobCancelled
+
 # Check for MPS (Mac) or CUDA
 if torch:
     device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
@@ -23,9 +25,54 @@ if os.path.exists(LOCAL_MODEL_PATH):
     MODEL_ID = LOCAL_MODEL_PATH
     print(f"Using local model from: {MODEL_ID}")
 
+# Pipeline components that carry weights (the tokenizer and scheduler are config only)
+WEIGHT_COMPONENTS = ["unet", "vae", "text_encoder"]
+
+def prepared_model_path(dtype):
+    """
+    Directory of the safetensors copy of the local model in the given dtype,
+    as written by scripts/prepare_model.py.
+    """
+    return f"{LOCAL_MODEL_PATH}-{str(dtype).replace('torch.', '')}"
+
+PREPARED_MODEL_PATH = prepared_model_path(dtype) if dtype is not None else None
+if PREPARED_MODEL_PATH and os.path.exists(PREPARED_MODEL_PATH):
+    print(f"Using prepared safetensors model from: {PREPARED_MODEL_PATH}")
+else:
+    PREPARED_MODEL_PATH = None
+
+def map_weights(pipe, model_dir):
+    """
+    Rebinds the pipeline weights to memory-mapped safetensors storage, so processes
+    loading the same files share one copy in the page cache instead of each holding its own.
+    Raises if the files do not cover the model exactly or are in a different dtype,
+    since the weights would then silently stay in private memory.
+    """
+    from safetensors.torch import load_file
+
+    for name in WEIGHT_COMPONENTS:
+        component_dir = os.path.join(model_dir, name)
+        state = {}
+        for filename in sorted(os.listdir(component_dir)):
+            if filename.endswith(".safetensors"):
+                state.update(load_file(os.path.join(component_dir, filename)))
+
+        module = getattr(pipe, name)
+        mismatched = [k for k, v in state.items() if v.dtype != module.dtype]
+        if mismatched:
+            raise RuntimeError(f"{name}: {len(mismatched)} tensors in {component_dir} are not {module.dtype}")
+        result = module.load_state_dict(state, strict=False, assign=True)
+        if result.missing_keys or result.unexpected_keys:
+            raise RuntimeError(
+                f"{name}: safetensors keys do not match the model "
+                f"(missing {len(result.missing_keys)}, unexpected {len(result.unexpected_keys)})"
+            )
+
 class CreativeGenerator:
     def __init__(self):
         self.pipe = None
+        self.img2img = None
+        self.model_path = None
         self.device = device
         print(f"Initializing Generator on {self.device}...")
 
@@ -38,12 +85,30 @@ class CreativeGenerator:
             try:
                 # Switching to Text-to-Image for Background Generation as per user request
                 from diffusers import StableDiffusionPipeline
-                self.pipe = StableDiffusionPipeline.from_pretrained(
-                    MODEL_ID,
-                    torch_dtype=dtype,
-                    use_safetensors=False,
-                    safety_checker=None
-                ).to(self.device)
+                if PREPARED_MODEL_PATH:
+                    # Converted weights are already in the target dtype, so on CPU the
+                    # parameters can point straight at the mapped files.
+                    try:
+                        pipe = StableDiffusionPipeline.from_pretrained(
+                            PREPARED_MODEL_PATH,
+                            torch_dtype=dtype,
+                            use_safetensors=True,
+                            safety_checker=None
+                        )
+                        if self.device == "cpu":
+                            map_weights(pipe, PREPARED_MODEL_PATH)
+                        self.pipe = pipe.to(self.device)
+                        self.model_path = PREPARED_MODEL_PATH
+                    except Exception as e:
+                        print(f"Error loading prepared model ({e}). Falling back to {MODEL_ID}.")
+                if self.pipe is None:
+                    self.pipe = StableDiffusionPipeline.from_pretrained(
+                        MODEL_ID,
+                        torch_dtype=dtype,
+                        use_safetensors=False,
+                        safety_checker=None
+                    ).to(self.device)
+                    self.model_path = MODEL_ID
                 print("Model loaded successfully (Text-to-Image).")
             except Exception as e:
                 print(f"Error loading model: {e}")
@@ -72,17 +137,60 @@ class CreativeGenerator:
         
         return shadow
 
-    def generate(self, product_image, prompt, negative_prompt="", steps=30, guidance_scale=7.5, seed=None):
+    def load_img2img(self):
+        """
+        Builds the Image-to-Image pipeline on top of the loaded Text-to-Image components,
+        so variations reuse the same UNet/VAE/text encoder instead of loading a second copy.
+        """
+        if self.img2img is None and self.pipe is not None:
+            self.img2img = StableDiffusionImg2ImgPipeline(**self.pipe.components, requires_safety_checker=False)
+        return self.img2img
+
+    def step_hook(self, steps, callback=None, cancel_token=None):
+        """
+        Builds a callback_on_step_end hook that reports (step, total_steps) to callback
+        and aborts the pipeline within one denoising step once cancel_token is set.
+        """
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            if callback:
+                callback(step + 1, getattr(pipe, "num_timesteps", steps))
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            return callback_kwargs
+        return on_step_end
+
+    def composite(self, product_image, background):
+        """
+        Resizes a generated background to the canvas and places the product (with shadow) on top.
+        """
+        background = background.resize(product_image.size, Image.Resampling.LANCZOS)
+        
+        shadow_layer = self.add_shadow(product_image)
+        
+        final_comp = Image.alpha_composite(background.convert("RGBA"), shadow_layer)
+        final_comp = Image.alpha_composite(final_comp, product_image)
+        
+        return final_comp.convert("RGB")
+
+    def generate(self, product_image, prompt, negative_prompt="", steps=30, guidance_scale=7.5, seed=None, return_background=False,
+                 callback=None, cancel_token=None):
         """
         Generates a background using Text-to-Image and composites the product on top.
+        With return_background=True, returns (image, background) so the background can be
+        reused later for variations. callback(step, total_steps) is called after every
+        denoising step; setting cancel_token raises JobCancelled within one step.
         """
+        failed = (None, None) if return_background else None
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+
         if torch is None or self.pipe is None:
             if torch is None:
                 self.load_model()
             elif self.pipe is None:
                 self.load_model()
                 if self.pipe is None and torch:
-                     return None
+                     return failed
 
         # Mock generation if no pipe
         if self.pipe is None:
@@ -91,9 +199,13 @@ class CreativeGenerator:
             color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
             base_image = Image.new("RGB", product_image.size, color)
             base_image.paste(product_image, (0, 0), product_image)
+            if callback:
+                callback(steps, steps)
+            if return_background:
+                return base_image, Image.new("RGB", (512, 512), color)
             return base_image
 
-        generator = torch.Generator(self.device).manual_seed(seed) if seed else None
+        generator = torch.Generator(self.device).manual_seed(seed) if seed is not None else None
 
         try:
             # 1. Generate Background (Text-to-Image)
@@ -105,21 +217,75 @@ class CreativeGenerator:
                 width=512,
                 num_inference_steps=steps,
                 guidance_scale=guidance_scale,
-                generator=generator
+                generator=generator,
+                callback_on_step_end=self.step_hook(steps, callback, cancel_token)
             ).images[0]
             
-            bg_output = bg_output.resize(product_image.size, Image.Resampling.LANCZOS)
-            
-            shadow_layer = self.add_shadow(product_image)
+            final_comp = self.composite(product_image, bg_output)
+            if return_background:
+                return final_comp, bg_output
+            return final_comp
             
-            final_comp = Image.alpha_composite(bg_output.convert("RGBA"), shadow_layer)
-            final_comp = Image.alpha_composite(final_comp, product_image)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            print(f"Generation error: {e}")
+            return failed
+
+    def vary(self, product_image, background, prompt, negative_prompt="", strength=0.5, steps=30, guidance_scale=7.5, seed=None,
+             callback=None, cancel_token=None):
+        """
+        Generates a variation of a previous background using Image-to-Image and
+        composites the product on top. Only about strength * steps denoising steps run,
+        so lower strengths are both faster and closer to the original.
+        callback and cancel_token behave as in generate().
+
+        Returns:
+            tuple: (image, background), or (None, None) on failure.
+        """
+        if not 0 < strength <= 1:
+            raise ValueError(f"strength must be in (0, 1], got {strength}")
+        # img2img runs int(steps * strength) steps; make sure that is at least one
+        while int(steps * strength) < 1:
+            steps += 1
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if self.pipe is None:
+            self.load_model()
+
+        # Mock variation if no pipe: tint the previous background
+        if self.pipe is None:
+            if torch is not None:
+                return None, None
+            print(f"Mock Varying for prompt: {prompt[:30]}...")
+            import random
+            tint = Image.new("RGB", background.size, (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)))
+            bg_output = Image.blend(background.convert("RGB"), tint, strength)
+            if callback:
+                callback(int(steps * strength), int(steps * strength))
+            return self.composite(product_image, bg_output), bg_output
+
+        generator = torch.Generator(self.device).manual_seed(seed) if seed is not None else None
+
+        try:
+            bg_output = self.load_img2img()(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                image=background.convert("RGB").resize((512, 512), Image.Resampling.LANCZOS),
+                strength=strength,
+                num_inference_steps=steps,
+                guidance_scale=guidance_scale,
+                generator=generator,
+                callback_on_step_end=self.step_hook(int(steps * strength), callback, cancel_token)
+            ).images[0]
             
-            return final_comp.convert("RGB")
+            return self.composite(product_image, bg_output), bg_output
             
+        except JobCancelled:
+            raise
         except Exception as e:
-            print(f"Generation error: {e}")
-            return None
+            print(f"Variation error: {e}")
+            return None, None
 
 def overlay_logo(background_image, logo_path, position="top-right", scale=0.15, padding=20):
     """
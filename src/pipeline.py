@@ -1,3 +1,4 @@
+import io
 import os
 import shutil
 import zipfile
@@ -11,10 +12,18 @@ from .preprocessing import resize_image, remove_background, create_composition
 from .generation import CreativeGenerator, overlay_logo
 from .generation import CreativeGenerator, overlay_logo
 from .captioning import CaptionGenerator
+from .progress import ProgressTracker
+from .sharded import ShardedExecutor
+
+NEGATIVE_PROMPT = "text, watermark, label, writing, signature, logo, brand, typography, bad quality, blurry, distorted, other products, bottles, boxes"
 
 class AutoCreativeEngine:
-    def __init__(self):
-        self.generator = CreativeGenerator()
+    def __init__(self, workers=1, seed=None, generator=None):
+        # An already-loaded generator can be passed in to share one model between engines
+        self.generator = generator or CreativeGenerator()
+        self.seed = seed
+        # With more than one worker, variations are rendered by a pool of model processes
+        self.executor = ShardedExecutor(num_workers=workers) if workers > 1 else None
         self.captioner = CaptionGenerator(provider="groq") # Default to Groq
         self.base_dir = os.path.dirname(os.path.dirname(__file__))
         self.output_dir = os.path.join(self.base_dir, "final_output")
@@ -22,6 +31,8 @@ class AutoCreativeEngine:
         self.raw_dir = os.path.join(self.generated_dir, "raw")
         self.final_dir = os.path.join(self.generated_dir, "final")
         self.captions_dir = os.path.join(self.base_dir, "captions")
+        # Inputs of the last run, kept so its backgrounds can be varied later
+        self.job = None
         
         os.makedirs(self.output_dir, exist_ok=True)
         # Directories are now created in run() to be temporary
@@ -29,99 +40,205 @@ class AutoCreativeEngine:
         # os.makedirs(self.final_dir, exist_ok=True)
         # os.makedirs(self.captions_dir, exist_ok=True)
 
-    def run(self, logo_path, product_path, product_name="Product"):
+    def run(self, logo_path, product_path, product_name="Product", progress=None, cancel_token=None):
+        """
+        Runs the full job. progress(info) receives step-level updates (see
+        progress.format_progress); setting cancel_token stops the job within one
+        denoising step and raises JobCancelled after the scratch directories are removed.
+        """
         print("Starting Auto-Creative Engine...")
         
         os.makedirs(self.raw_dir, exist_ok=True)
         os.makedirs(self.final_dir, exist_ok=True)
         os.makedirs(self.captions_dir, exist_ok=True)
         
-        print("Preprocessing images...")
-        product_img = Image.open(product_path).convert("RGBA")
-        logo_img = Image.open(logo_path).convert("RGBA")
-        
         try:
-            product_img = remove_background(product_img)
-        except:
-            print("Background removal skipped (module not working).")
+            print("Preprocessing images...")
+            product_img = Image.open(product_path).convert("RGBA")
+            logo_img = Image.open(logo_path).convert("RGBA")
+        
+            try:
+                product_img = remove_background(product_img)
+            except:
+                print("Background removal skipped (module not working).")
             
-        product_img = create_composition(product_img, background_size=(1024, 1024), product_scale=0.8)
+            product_img = create_composition(product_img, background_size=(1024, 1024), product_scale=0.8)
         
-        preprocessing_dir = os.path.join(self.base_dir, "preprocessing")
-        os.makedirs(preprocessing_dir, exist_ok=True)
-        preprocessed_path = os.path.join(preprocessing_dir, "processed_input.png")
-        product_img.save(preprocessed_path)
-        print(f"Saved preprocessed image to {preprocessed_path}")
+            preprocessing_dir = os.path.join(self.base_dir, "preprocessing")
+            os.makedirs(preprocessing_dir, exist_ok=True)
+            preprocessed_path = os.path.join(preprocessing_dir, "processed_input.png")
+            product_img.save(preprocessed_path)
+            print(f"Saved preprocessed image to {preprocessed_path}")
         
-        print(f"Generating dynamic prompts for '{product_name}'...")
+            print(f"Generating dynamic prompts for '{product_name}'...")
         
-        try:
-            variations = self.captioner.generate_image_prompts(product_name, n=4)
-            print(f"Generated {len(variations)} prompts.")
-        except Exception as e:
-            print(f"Failed to generate prompts: {e}")
-            variations = ["clean studio background", "outdoor nature scene", "luxury setting", "minimalist pastel"]
+            try:
+                variations = self.captioner.generate_image_prompts(product_name, n=4)
+                print(f"Generated {len(variations)} prompts.")
+            except Exception as e:
+                print(f"Failed to generate prompts: {e}")
+                variations = ["clean studio background", "outdoor nature scene", "luxury setting", "minimalist pastel"]
         
-        generated_files = []
-        caption_files = []
+            generated_files = []
+            caption_files = []
         
-        print(f"Generating {len(variations)} variations...")
-        results = []
+            print(f"Generating {len(variations)} variations...")
+            results = []
         
-        for i, var_prompt in enumerate(variations):
-            full_prompt = f"{var_prompt}, empty scene, background texture only, no objects"
-            print(f"Variation {i+1}: {full_prompt}")
-            
-            negative_prompt = "text, watermark, label, writing, signature, logo, brand, typography, bad quality, blurry, distorted, other products, bottles, boxes"
-            gen_img = self.generator.generate(product_img, full_prompt, negative_prompt=negative_prompt)
-            if gen_img:
-                raw_filename = f"raw_{i+1:03d}.png"
-                raw_path = os.path.join(self.raw_dir, raw_filename)
-                gen_img.save(raw_path)
-
-                final_img = overlay_logo(gen_img, logo_path)
+            self.job = {"product_img": product_img, "logo_path": logo_path, "product_name": product_name}
+            full_prompts = [f"{var_prompt}, empty scene, background texture only, no objects" for var_prompt in variations]
+            generated = self.render_variations(product_img, full_prompts, NEGATIVE_PROMPT, progress, cancel_token)
+        
+            for i, (var_prompt, (gen_img, background)) in enumerate(zip(variations, generated)):
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
+                if gen_img:
+                    raw_filename = f"raw_{i+1:03d}.png"
+                    raw_path = os.path.join(self.raw_dir, raw_filename)
+                    gen_img.save(raw_path)
+
+                    final_img = overlay_logo(gen_img, logo_path)
                 
-                filename = f"creative_{i+1:03d}.png"
-                save_path = os.path.join(self.final_dir, filename)
-                final_img.save(save_path)
-                generated_files.append(save_path)
+                    filename = f"creative_{i+1:03d}.png"
+                    save_path = os.path.join(self.final_dir, filename)
+                    final_img.save(save_path)
+                    generated_files.append(save_path)
                 
-                caption = self.captioner.generate_caption(product_name, var_prompt)
-                cap_filename = f"caption_{i+1:03d}.txt"
-                cap_path = os.path.join(self.captions_dir, cap_filename)
-                with open(cap_path, "w") as f:
-                    f.write(caption)
-                caption_files.append(cap_path)
+                    caption = self.captioner.generate_caption(product_name, var_prompt)
+                    cap_filename = f"caption_{i+1:03d}.txt"
+                    cap_path = os.path.join(self.captions_dir, cap_filename)
+                    with open(cap_path, "w") as f:
+                        f.write(caption)
+                    caption_files.append(cap_path)
                 
-                results.append({
-                    "image": final_img,
-                    "caption": caption
-                })
+                    results.append({
+                        "image": final_img,
+                        "caption": caption,
+                        "prompt": var_prompt,
+                        "background": background
+                    })
                 
-        print("Packaging results...")
-        zip_name = f"auto_creative_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-        zip_path = os.path.join(self.output_dir, zip_name)
+            print("Packaging results...")
+            zip_name = f"auto_creative_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+            zip_path = os.path.join(self.output_dir, zip_name)
         
-        with zipfile.ZipFile(zip_path, 'w') as zf:
-            for f in generated_files:
-                zf.write(f, os.path.basename(f))
-            for f in caption_files:
-                zf.write(f, os.path.basename(f))
+            with zipfile.ZipFile(zip_path, 'w') as zf:
+                for f in generated_files:
+                    zf.write(f, os.path.basename(f))
+                for f in caption_files:
+                    zf.write(f, os.path.basename(f))
                 
-        print(f"Done! Results saved to {zip_path}")
-        
-        print("Cleaning up intermediate files...")
-        try:
-            shutil.rmtree(self.generated_dir)
-            shutil.rmtree(self.captions_dir)
-            preprocessing_dir = os.path.join(self.base_dir, "preprocessing")
-            if os.path.exists(preprocessing_dir):
-                shutil.rmtree(preprocessing_dir)
-        except Exception as e:
-            print(f"Cleanup warning: {e}")
+            print(f"Done! Results saved to {zip_path}")
+
+        finally:
+            # Runs on success, errors and cancellation so scratch directories never linger
+            print("Cleaning up intermediate files...")
+            try:
+                shutil.rmtree(self.generated_dir)
+                shutil.rmtree(self.captions_dir)
+                preprocessing_dir = os.path.join(self.base_dir, "preprocessing")
+                if os.path.exists(preprocessing_dir):
+                    shutil.rmtree(preprocessing_dir)
+            except Exception as e:
+                print(f"Cleanup warning: {e}")
 
         return zip_path, results
 
+    def render_variations(self, product_img, prompts, negative_prompt="", progress=None, cancel_token=None, steps=30):
+        """
+        Renders one (image, background) pair per prompt, on the worker pool if one is configured.
+        Variation i is seeded with seed + i so results do not depend on where it ran.
+        """
+        for i, prompt in enumerate(prompts):
+            print(f"Variation {i+1}: {prompt}")
+
+        tracker = ProgressTracker(progress, len(prompts), steps)
+        if self.executor:
+            return self.executor.map(
+                product_img, prompts, negative_prompt=negative_prompt, seed=self.seed, steps=steps,
+                progress=tracker, cancel_token=cancel_token
+            )
+
+        images = []
+        for i, prompt in enumerate(prompts):
+            seed = self.seed + i if self.seed is not None else None
+            images.append(self.generator.generate(
+                product_img, prompt, negative_prompt=negative_prompt, seed=seed, steps=steps, return_background=True,
+                callback=tracker.step_callback(i), cancel_token=cancel_token
+            ))
+        return images
+
+    def vary(self, result, strength=0.5, seed=None, progress=None, cancel_token=None, job=None):
+        """
+        Generates "more like this" for a result of the last run by re-noising its
+        background with Image-to-Image instead of rendering a new one from scratch.
+
+        Args:
+            result (dict): An entry of the results returned by run().
+            strength (float): In (0, 1], how far to move from the original background.
+            seed (int): Optional seed for the variation.
+            progress (callable): Receives step-level progress updates, as in run().
+            cancel_token (CancellationToken): Stops the variation within one step.
+            job (dict): The run the result came from (self.job of that run). Defaults to
+                this engine's last run.
+
+        Returns:
+            dict: A new result with the same keys, or None if generation failed.
+        """
+        if not 0 < strength <= 1:
+            raise ValueError(f"strength must be in (0, 1], got {strength}")
+        job = job or self.job
+        if job is None:
+            raise RuntimeError("No previous run to vary. Call run() first.")
+
+        full_prompt = f"{result['prompt']}, empty scene, background texture only, no objects"
+        print(f"Varying '{result['prompt']}' at strength {strength}...")
+        tracker = ProgressTracker(progress, 1, 30)
+        if self.executor:
+            # The models live in the workers; loading one here would duplicate them
+            gen_img, background = self.executor.vary(
+                job["product_img"], result["background"], full_prompt,
+                negative_prompt=NEGATIVE_PROMPT, strength=strength, seed=seed,
+                progress=tracker, cancel_token=cancel_token
+            )
+        else:
+            gen_img, background = self.generator.vary(
+                job["product_img"], result["background"], full_prompt,
+                negative_prompt=NEGATIVE_PROMPT, strength=strength, seed=seed,
+                callback=tracker.step_callback(0), cancel_token=cancel_token
+            )
+        if gen_img is None:
+            return None
+
+        final_img = overlay_logo(gen_img, job["logo_path"])
+        caption = self.captioner.generate_caption(job["product_name"], result["prompt"])
+        return {
+            "image": final_img,
+            "caption": caption,
+            "prompt": result["prompt"],
+            "background": background
+        }
+
+    def add_to_package(self, zip_path, result):
+        """
+        Appends a result (e.g. from vary()) to an existing results ZIP as the next
+        creative/caption pair, so variations are included in the download.
+        """
+        with zipfile.ZipFile(zip_path, 'a') as zf:
+            names = set(zf.namelist())
+            n = sum(1 for name in names if name.startswith("creative_")) + 1
+            while f"creative_{n:03d}.png" in names:
+                n += 1
+
+            buf = io.BytesIO()
+            result["image"].save(buf, format="PNG")
+            zf.writestr(f"creative_{n:03d}.png", buf.getvalue())
+            zf.writestr(f"caption_{n:03d}.txt", result["caption"])
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+
 if __name__ == "__main__":
     # CLI Entry point
     l, p = get_inputs()
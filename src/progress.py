@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class JobCancelled(Exception):
+    """Raised when a generation job is stopped through its CancellationToken."""
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag checked by the generator after every denoising step.
+    Wraps any Event-like object, so a multiprocessing Event can be used to reach workers.
+    """
+
+    def __init__(self, event=None):
+        self.event = event or threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def reset(self):
+        self.event.clear()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise JobCancelled()
+
+
+class ProgressTracker:
+    """
+    Aggregates per-step updates from all variations of a job into progress reports
+    (variation i/N, step s/S, ETA) and forwards them to a callback.
+
+    Args:
+        callback (callable): Called with a progress dict on every update.
+        variations (int): Number of variations in the job.
+        steps (int): Expected denoising steps per variation.
+    """
+
+    def __init__(self, callback, variations, steps):
+        self.callback = callback
+        self.variations = variations
+        self.steps = steps
+        self.done = [0] * variations
+        self.start_time = time.monotonic()
+
+    def update(self, index, step, total_steps):
+        self.done[index] = step
+        self.steps = total_steps
+
+        completed = sum(self.done)
+        total = self.variations * self.steps
+        elapsed = time.monotonic() - self.start_time
+        eta = elapsed * (total - completed) / completed if completed else None
+
+        if self.callback:
+            self.callback({
+                "variation": index + 1,
+                "variations": self.variations,
+                "step": step,
+                "steps": total_steps,
+                "fraction": completed / total if total else 1.0,
+                "eta": eta
+            })
+
+    def step_callback(self, index):
+        """
+        Returns a (step, total_steps) callback for CreativeGenerator bound to one variation.
+        """
+        return lambda step, total_steps: self.update(index, step, total_steps)
+
+
+def format_progress(info):
+    eta = f"{info['eta']:.0f}s" if info["eta"] is not None else "--"
+    return f"Variation {info['variation']}/{info['variations']} | Step {info['step']}/{info['steps']} | ETA {eta}"
@@ -0,0 +1,490 @@
+import os
+import random
+import signal
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+from PIL import Image
+
+from .progress import CancellationToken, JobCancelled
+
+# Worker processes import torch/diffusers themselves, so keep this module free of
+# heavy imports: it is unpickled in every spawned child.
+
+TASK_RETRIES = 2
+POLL_INTERVAL = 0.25
+SHUTDOWN_TIMEOUT = 10
+SYSFS_ROOT = "/sys/devices/system"
+
+
+def _read_cpulist(path):
+    """
+    Parses a sysfs CPU list such as "0-3,32-35" into a list of CPU ids.
+    """
+    with open(path) as f:
+        text = f.read().strip()
+    cpus = []
+    for part in filter(None, text.split(",")):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_nodes(cpus):
+    """
+    Groups cpus by NUMA node, read from sysfs. Falls back to a single node holding
+    every cpu when the topology is not available (non-Linux, containers without /sys).
+    """
+    node_dir = os.path.join(SYSFS_ROOT, "node")
+    nodes = []
+    try:
+        names = sorted((n for n in os.listdir(node_dir) if n.startswith("node") and n[4:].isdigit()),
+                       key=lambda n: int(n[4:]))
+        for name in names:
+            node = [c for c in _read_cpulist(os.path.join(node_dir, name, "cpulist")) if c in cpus]
+            if node:
+                nodes.append(node)
+    except (OSError, ValueError):
+        return [list(cpus)]
+    return nodes or [list(cpus)]
+
+
+def physical_cores(cpus):
+    """
+    Groups cpus into physical cores using each cpu's thread_siblings_list, so hyperthread
+    siblings (e.g. cpu k and k+32) always land in the same worker. Each cpu is its own
+    core if the topology is not available.
+    """
+    cores = {}
+    for cpu in cpus:
+        path = os.path.join(SYSFS_ROOT, "cpu", f"cpu{cpu}", "topology", "thread_siblings_list")
+        try:
+            siblings = tuple(c for c in _read_cpulist(path) if c in cpus)
+        except (OSError, ValueError):
+            siblings = (cpu,)
+        cores[siblings or (cpu,)] = True
+    return sorted((list(core) for core in cores), key=lambda core: core[0])
+
+
+def _chunk(items, parts):
+    """
+    Splits items into `parts` contiguous chunks; chunks reuse items if there are too few.
+    """
+    chunks = []
+    per_part, extra = divmod(len(items), parts)
+    start = 0
+    for i in range(parts):
+        size = per_part + (1 if i < extra else 0)
+        chunks.append(items[start:start + size] or [items[i % len(items)]])
+        start += size
+    return chunks
+
+
+def _available_cpus():
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    return sorted(os.sched_getaffinity(0))
+
+
+def default_workers():
+    """
+    One worker per NUMA node: each holds a full SD model, so more workers than
+    nodes is an explicit choice rather than a default.
+    """
+    cpus = _available_cpus()
+    return len(numa_nodes(cpus)) if cpus else 1
+
+
+def split_cpus(num_workers, cpus=None):
+    """
+    Splits the CPUs available to this process into one slice per worker. Each slice stays
+    within one NUMA node, with workers spread over nodes in proportion to their size.
+    Within a node whole physical cores (with their hyperthread siblings) are handed out,
+    so workers only share a core when there are more workers than cores.
+
+    Args:
+        num_workers (int): Number of slices to produce.
+        cpus (list): CPU ids to split. Defaults to the current affinity mask.
+
+    Returns:
+        list: One list of CPU ids per worker (empty lists if affinity is unsupported).
+    """
+    if cpus is None:
+        cpus = _available_cpus()
+        if cpus is None:
+            return [[] for _ in range(num_workers)]
+    cpus = sorted(cpus)
+
+    nodes = numa_nodes(cpus)
+
+    # Largest-remainder allocation of workers to nodes by cpu count
+    shares = [num_workers * len(node) / len(cpus) for node in nodes]
+    counts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(nodes)), key=lambda i: shares[i] - counts[i], reverse=True)
+    for i in by_remainder[:num_workers - sum(counts)]:
+        counts[i] += 1
+
+    slices = []
+    for node, count in zip(nodes, counts):
+        if count == 0:
+            continue
+        for group in _chunk(physical_cores(node), count):
+            slices.append(sorted(cpu for core in group for cpu in core))
+    return slices
+
+
+def _attach_shared(name):
+    """
+    Attaches to a shared memory block owned by the parent without taking ownership of it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers the block, but spawned workers share the parent's
+        # resource tracker, so the registration is deduplicated and released on unlink.
+        return shared_memory.SharedMemory(name=name)
+
+
+def _pack(image):
+    return image.mode, image.size, image.tobytes()
+
+
+def _unpack(packed):
+    mode, size, raw = packed
+    return Image.frombytes(mode, size, raw)
+
+
+def _worker_main(cpus, threads, task_queue, result_conn, cancel_event):
+    """
+    Worker loop: pins itself to its CPU slice, loads a private warm model and runs
+    generate/vary tasks until it receives the shutdown sentinel. Step progress and results are sent
+    on the worker's own result pipe, and cancel_event stops the current variation within one step.
+    """
+    # Ctrl+C is handled by the parent, which cancels jobs through cancel_event.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+    from .generation import CreativeGenerator, torch
+
+    if torch is not None:
+        torch.set_num_threads(threads)
+        try:
+            # Variations already run in parallel across workers, so keep inter-op work serial
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+
+    generator = CreativeGenerator()
+    generator.load_model()
+    cancel_token = CancellationToken(cancel_event)
+
+    canvas_key = None
+    canvas = None
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        job_id, index, shm_name, mode, size, method, kwargs = task
+
+        # Variations of one job share the canvas, so only re-read it when the job changes.
+        # Keyed on job_id: shared memory names are random and may be reused after unlink.
+        if canvas_key != job_id:
+            shm = _attach_shared(shm_name)
+            try:
+                canvas = Image.frombytes(mode, size, bytes(shm.buf))
+            finally:
+                shm.close()
+            canvas_key = job_id
+
+        def report_step(step, total_steps):
+            result_conn.send(("step", job_id, index, (step, total_steps)))
+
+        try:
+            if method == "vary":
+                # img2img reuses this worker's loaded components rather than a new model copy
+                kwargs = dict(kwargs, background=_unpack(kwargs["background"]))
+                image, background = generator.vary(
+                    canvas, callback=report_step, cancel_token=cancel_token, **kwargs
+                )
+            else:
+                image, background = generator.generate(
+                    canvas, return_background=True, callback=report_step, cancel_token=cancel_token, **kwargs
+                )
+        except JobCancelled:
+            image = None
+
+        if image is None:
+            result_conn.send(("done", job_id, index, None))
+        else:
+            result_conn.send(("done", job_id, index, (_pack(image), _pack(background))))
+
+
+class _Worker:
+    def __init__(self, worker_id, cpus):
+        self.worker_id = worker_id
+        self.cpus = cpus
+        self.process = None
+        self.task_queue = None
+        self.conn = None
+        self.task = None
+
+
+class ShardedExecutor:
+    """
+    Spreads the variations of a job across several worker processes, each pinned to
+    its own CPU slice with its own warm CreativeGenerator.
+
+    The preprocessed product canvas is placed in shared memory once per job instead of
+    being pickled into every task. Results are gathered back in prompt order, seeds are
+    derived from the job seed and the variation index (so they do not depend on which
+    worker ran them), and a worker that dies is restarted with its task re-queued.
+    Cancelling a job stops every in-flight variation within one denoising step.
+    """
+
+    def __init__(self, num_workers=None, threads_per_worker=None):
+        self.num_workers = max(1, num_workers or default_workers())
+        self.cpu_slices = split_cpus(self.num_workers)
+        self.threads_per_worker = threads_per_worker
+        self.ctx = mp.get_context("spawn")
+        self.cancel_event = None
+        self.workers = []
+        self.job_id = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+
+    def start(self):
+        if self.workers:
+            return
+        print(f"Starting {self.num_workers} generation workers...")
+        self.cancel_event = self.ctx.Event()
+        self.workers = [_Worker(i, cpus) for i, cpus in enumerate(self.cpu_slices)]
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker):
+        threads = self.threads_per_worker or max(1, len(worker.cpus))
+        if worker.conn is not None:
+            worker.conn.close()
+        # One pipe per worker: a worker killed mid-message only breaks its own channel,
+        # instead of leaving a shared queue's write lock held for the whole pool.
+        worker.conn, result_conn = self.ctx.Pipe(duplex=False)
+        worker.task_queue = self.ctx.Queue()
+        worker.process = self.ctx.Process(
+            target=_worker_main,
+            args=(worker.cpus, threads, worker.task_queue, result_conn, self.cancel_event),
+            daemon=True,
+        )
+
+        # Spawned children copy the environment at start, which is the only point at which
+        # OpenMP/MKL read their thread counts.
+        saved = {k: os.environ.get(k) for k in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+        os.environ.update({k: str(threads) for k in saved})
+        try:
+            worker.process.start()
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        # Only the child keeps the write end, so its exit shows up as EOF on worker.conn
+        result_conn.close()
+
+    def _receive(self, timeout):
+        """
+        Yields (worker, message) for every worker with a message ready within timeout.
+        A broken pipe means the worker died; it is left for _recover to restart.
+        """
+        conns = {worker.conn: worker for worker in self.workers}
+        for conn in wait(list(conns), timeout):
+            worker = conns[conn]
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                worker.process.join(POLL_INTERVAL)
+                continue
+            yield worker, message
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.task_queue.put(None)
+        for worker in self.workers:
+            worker.process.join(SHUTDOWN_TIMEOUT)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.conn.close()
+        self.workers = []
+
+    def map(self, product_image, prompts, negative_prompt="", seed=None, progress=None, cancel_token=None, **kwargs):
+        """
+        Generates one image per prompt across the worker pool.
+
+        Args:
+            product_image (PIL.Image): Preprocessed product canvas.
+            prompts (list): Background prompts, one per variation.
+            negative_prompt (str): Negative prompt shared by all variations.
+            seed (int): Job seed; variation i uses seed + i. Random if None.
+            progress (ProgressTracker): Receives step updates from the workers.
+            cancel_token (CancellationToken): Stops the job when cancelled (raises JobCancelled).
+            **kwargs: Forwarded to CreativeGenerator.generate.
+
+        Returns:
+            list: (image, background) tuples in prompt order, (None, None) for failed variations.
+        """
+        if seed is None:
+            seed = random.randint(0, 2**31 - 1 - len(prompts))
+
+        calls = [
+            ("generate", dict(kwargs, prompt=prompt, negative_prompt=negative_prompt, seed=seed + i))
+            for i, prompt in enumerate(prompts)
+        ]
+        return self._submit(product_image, calls, progress, cancel_token)
+
+    def vary(self, product_image, background, prompt, progress=None, cancel_token=None, **kwargs):
+        """
+        Runs CreativeGenerator.vary on one of the workers, so "more like this" reuses a
+        worker's loaded model instead of loading another copy in this process.
+
+        Args:
+            product_image (PIL.Image): Preprocessed product canvas.
+            background (PIL.Image): Background to vary.
+            prompt (str): Background prompt.
+            progress (ProgressTracker): Receives step updates from the worker.
+            cancel_token (CancellationToken): Stops the variation when cancelled (raises JobCancelled).
+            **kwargs: Forwarded to CreativeGenerator.vary.
+
+        Returns:
+            tuple: (image, background), or (None, None) on failure.
+        """
+        call = ("vary", dict(kwargs, background=_pack(background), prompt=prompt))
+        return self._submit(product_image, [call], progress, cancel_token)[0]
+
+    def _submit(self, product_image, calls, progress=None, cancel_token=None):
+        """
+        Shares the canvas with the workers and runs one (method, kwargs) task per call.
+        """
+        self.start()
+        self.job_id += 1
+
+        data = product_image.tobytes()
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        try:
+            shm.buf[:len(data)] = data
+            tasks = [
+                (self.job_id, i, shm.name, product_image.mode, product_image.size, method, kwargs)
+                for i, (method, kwargs) in enumerate(calls)
+            ]
+            try:
+                return self._run(tasks, progress, cancel_token)
+            except BaseException:
+                # Covers cancellation as well as interrupts raised from progress callbacks
+                self._cancel()
+                raise
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def _run(self, tasks, progress=None, cancel_token=None):
+        pending = list(reversed(tasks))
+        attempts = {}
+        results = [(None, None)] * len(tasks)
+        remaining = len(tasks)
+        next_check = time.monotonic() + POLL_INTERVAL
+
+        while remaining:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+
+            for worker in self.workers:
+                if worker.task is None and pending:
+                    worker.task = pending.pop()
+                    worker.task_queue.put(worker.task)
+
+            for worker, (kind, job_id, index, payload) in self._receive(POLL_INTERVAL):
+                if worker.task is None or worker.task[:2] != (job_id, index):
+                    continue
+                if kind == "step":
+                    if progress:
+                        progress.update(index, *payload)
+                    continue
+
+                worker.task = None
+                remaining -= 1
+                if payload is not None:
+                    results[index] = tuple(_unpack(packed) for packed in payload)
+
+            # Busy workers stream a step message every step, so liveness is checked on a
+            # timer rather than only when the pipes go quiet.
+            if time.monotonic() >= next_check:
+                remaining -= self._recover(pending, attempts)
+                next_check = time.monotonic() + POLL_INTERVAL
+
+        return results
+
+    def _cancel(self):
+        """
+        Signals in-flight variations to stop and waits for their workers to go idle.
+        Workers that do not respond in time (or died) are restarted with a fresh result
+        pipe, so a message cut off by terminate() is never read by a later job.
+        """
+        self.cancel_event.set()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        try:
+            while any(w.task is not None and w.process.is_alive() for w in self.workers):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                for worker, (kind, job_id, index, payload) in self._receive(min(timeout, POLL_INTERVAL)):
+                    if kind == "done" and worker.task is not None and worker.task[:2] == (job_id, index):
+                        worker.task = None
+
+            for worker in self.workers:
+                if worker.task is not None:
+                    if worker.process.is_alive():
+                        worker.process.terminate()
+                        worker.process.join()
+                    worker.task = None
+                    self._spawn(worker)
+        finally:
+            self.cancel_event.clear()
+
+    def _recover(self, pending, attempts):
+        """
+        Restarts dead workers and re-queues their in-flight task.
+
+        Returns:
+            int: Number of tasks given up on after exhausting their retries.
+        """
+        dropped = 0
+        for worker in self.workers:
+            if worker.process.is_alive():
+                continue
+
+            print(f"Worker {worker.worker_id} exited (code {worker.process.exitcode}), restarting...")
+            task = worker.task
+            worker.task = None
+            self._spawn(worker)
+
+            if task is None:
+                continue
+            index = task[1]
+            attempts[index] = attempts.get(index, 0) + 1
+            if attempts[index] > TASK_RETRIES:
+                print(f"Variation {index+1} failed after {TASK_RETRIES} retries, skipping.")
+                dropped += 1
+            else:
+                pending.append(task)
+        return dropped